@@ -233,9 +233,16 @@ def DoInline(
           filename_expansion_function=filename_expansion_function))
       return ""
 
-    return pattern % InlineToString(
-        filepath, grd_node, allow_external_script,
-        filename_expansion_function=filename_expansion_function)
+    try:
+      inlined = DoInline(
+          filepath, grd_node, allow_external_script,
+          filename_expansion_function=filename_expansion_function)
+    except IOError, e:
+      raise Exception("Failed to open %s while trying to flatten %s. (%s)" %
+                      (e.filename, filepath, e.strerror))
+    # Report the files the nested file inlined as well.
+    inlined_files.update(inlined.inlined_files)
+    return pattern % inlined.inlined_data
 
   def InlineIncludeFiles(src_match):
     """Helper function to directly inline generic external files (without
@@ -177,6 +177,34 @@ class HtmlInlineUnittest(unittest.TestCase):
 
     tmp_dir.CleanUp()
 
+  def testNestedInlinedFiles(self):
+    '''Tests that files inlined by inlined files are reported by DoInline.'''
+
+    files = {
+      'index.html': '''
+      <html>
+      <script src="outer.js"></script>
+      </html>
+      ''',
+
+      'outer.js': '''
+      <include src="inner.js">
+      ''',
+
+      'inner.js': '''
+      var inner = 1;
+      ''',
+    }
+
+    tmp_dir = util.TempDir(files)
+    result = html_inline.DoInline(tmp_dir.GetPath('index.html'), None)
+    self.failUnlessEqual(set([tmp_dir.GetPath('outer.js'),
+                              tmp_dir.GetPath('inner.js')]),
+                         result.inlined_files)
+    self.failUnless('var inner = 1;' in result.inlined_data)
+
+    tmp_dir.CleanUp()
+
   def testInlineCSSLinks(self):
     '''Tests that only CSS files referenced via relative URLs are inlined.'''
 
@@ -8,15 +8,16 @@
 
 import os
 import types
-import re
+import warnings
 from functools import partial
 
+from grit import lazy_re
 from grit import util
 from grit.node import misc
 
 
 def Format(root, lang='en', output_dir='.'):
-  from grit.node import empty, include, message, structure
+  from grit.node import empty, include, structure
 
   yield _FormatHeader(root, lang, output_dir)
 
@@ -24,12 +25,7 @@ def Format(root, lang='en', output_dir='.'):
     if isinstance(item, empty.MessagesNode):
       # Write one STRINGTABLE per <messages> container.
       # This is hacky: it iterates over the children twice.
-      yield 'STRINGTABLE\nBEGIN\n'
-      for subitem in item.ActiveDescendants():
-        if isinstance(subitem, message.MessageNode):
-          with subitem:
-            yield FormatMessage(subitem, lang)
-      yield 'END\n\n'
+      yield _FormatStringTable(item, lang)
     elif isinstance(item, include.IncludeNode):
       with item:
         yield FormatInclude(item, lang, output_dir)
@@ -251,61 +247,97 @@ _LANGUAGE_DIRECTIVE_PAIR = {
   'fake-bidi'   : 'LANG_HEBREW, SUBLANG_DEFAULT',
 }
 
+# The values of the GRIT expand variables GRITVERLANGCHARSETHEX, GRITVERLANGID
+# and GRITVERCHARSETID for each language in _LANGUAGE_CHARSET_PAIR.
+_LANGUAGE_INFO = dict(
+    (language, (langcharset, '0x' + langcharset[0:4],
+                str(int(langcharset[4:], 16))))
+    for language, langcharset in _LANGUAGE_CHARSET_PAIR.iteritems())
+
+# The substitutions RcSubstitutions() adds for each language in
+# _LANGUAGE_CHARSET_PAIR.  AddSubstitutions() copies them, so the
+# dictionaries can be shared between calls.
+_RC_SUBSTITUTIONS = dict(
+    (language, {'GRITVERLANGCHARSETHEX': langcharset,
+                'GRITVERLANGID': lang_id,
+                'GRITVERCHARSETID': charset_id})
+    for language, (langcharset, lang_id, charset_id)
+    in _LANGUAGE_INFO.iteritems())
+
 # A note on 'no-specific-language' in the following few functions:
 # Some build systems may wish to call GRIT to scan for dependencies in
 # a language-agnostic way, and can then specify this fake language as
 # the output context.  It should never be used when output is actually
 # being generated.
 
+# (function name, language) pairs that have already been warned about, so
+# that a build with an unknown language only reports it once per lookup.
+_warned_missing = set()
+
+
+def _WarnUndefinedLanguage(function_name, language):
+  if (function_name, language) not in _warned_missing:
+    _warned_missing.add((function_name, language))
+    # Point the warning at the code that called the lookup function.
+    warnings.warn('%s() found undefined language %s' %
+                  (function_name, language), stacklevel=3)
+
+
 def GetLangCharsetPair(language):
-  if _LANGUAGE_CHARSET_PAIR.has_key(language):
-    return _LANGUAGE_CHARSET_PAIR[language]
+  langcharset = _LANGUAGE_CHARSET_PAIR.get(language)
+  if langcharset is not None:
+    return langcharset
   elif language == 'no-specific-language':
     return ''
   else:
-    print 'Warning:GetLangCharsetPair() found undefined language %s' %(language)
+    _WarnUndefinedLanguage('GetLangCharsetPair', language)
     return ''
 
 def GetLangDirectivePair(language):
-  if _LANGUAGE_DIRECTIVE_PAIR.has_key(language):
-    return _LANGUAGE_DIRECTIVE_PAIR[language]
+  directive = _LANGUAGE_DIRECTIVE_PAIR.get(language)
+  if directive is not None:
+    return directive
   else:
     # We don't check for 'no-specific-language' here because this
     # function should only get called when output is being formatted,
     # and at that point we would not want to get
     # 'no-specific-language' passed as the language.
-    print ('Warning:GetLangDirectivePair() found undefined language %s' %
-           language)
+    _WarnUndefinedLanguage('GetLangDirectivePair', language)
     return 'unknown language: see tools/grit/format/rc.py'
 
 def GetLangIdHex(language):
-  if _LANGUAGE_CHARSET_PAIR.has_key(language):
-    langcharset = _LANGUAGE_CHARSET_PAIR[language]
-    lang_id = '0x' + langcharset[0:4]
-    return lang_id
+  info = _LANGUAGE_INFO.get(language)
+  if info is not None:
+    return info[1]
   elif language == 'no-specific-language':
     return ''
   else:
-    print 'Warning:GetLangIdHex() found undefined language %s' %(language)
+    _WarnUndefinedLanguage('GetLangIdHex', language)
     return ''
 
 
 def GetCharsetIdDecimal(language):
-  if _LANGUAGE_CHARSET_PAIR.has_key(language):
-    langcharset = _LANGUAGE_CHARSET_PAIR[language]
-    charset_decimal = int(langcharset[4:], 16)
-    return str(charset_decimal)
+  info = _LANGUAGE_INFO.get(language)
+  if info is not None:
+    return info[2]
   elif language == 'no-specific-language':
     return ''
   else:
-    print 'Warning:GetCharsetIdDecimal() found undefined language %s' % language
+    _WarnUndefinedLanguage('GetCharsetIdDecimal', language)
     return ''
 
 
+# Matches language codes like 'pt_br' that GetUnifiedLangCode converts.
+_UNDERSCORE_LANG_CODE = lazy_re.compile('([a-z]{1,2})_([a-z]{1,2})')
+
+
 def GetUnifiedLangCode(language) :
-  r = re.compile('([a-z]{1,2})_([a-z]{1,2})')
-  if r.match(language) :
-    underscore = language.find('_')
+  if '_' not in language :
+    # Most language codes are already in unified form.
+    return language
+  m = _UNDERSCORE_LANG_CODE.match(language)
+  if m :
+    underscore = m.end(1)
     return language[0:underscore] + '-' + language[underscore + 1:].upper()
   else :
     return language
@@ -314,10 +346,30 @@ def GetUnifiedLangCode(language) :
 def RcSubstitutions(substituter, lang):
   '''Add language-based substitutions for Rc files to the substitutor.'''
   unified_lang_code = GetUnifiedLangCode(lang)
-  substituter.AddSubstitutions({
-      'GRITVERLANGCHARSETHEX': GetLangCharsetPair(unified_lang_code),
-      'GRITVERLANGID': GetLangIdHex(unified_lang_code),
-      'GRITVERCHARSETID': GetCharsetIdDecimal(unified_lang_code)})
+  substitutions = _RC_SUBSTITUTIONS.get(unified_lang_code)
+  if substitutions is None:
+    # Let the lookup functions handle (and warn about) unknown languages.
+    substitutions = {
+        'GRITVERLANGCHARSETHEX': GetLangCharsetPair(unified_lang_code),
+        'GRITVERLANGID': GetLangIdHex(unified_lang_code),
+        'GRITVERCHARSETID': GetCharsetIdDecimal(unified_lang_code)}
+  substituter.AddSubstitutions(substitutions)
+
+
+# The preamble of every RC file, filled in by _FormatHeader().
+_HEADER_TEMPLATE = '''// This file is automatically generated by GRIT.  Do not edit.
+
+#include "%(resource_header)s"
+#include <winresrc.h>
+#ifdef IDC_STATIC
+#undef IDC_STATIC
+#endif
+#define IDC_STATIC (-1)
+
+%(language_directive)s
+
+
+'''
 
 
 def _FormatHeader(root, lang, output_dir):
@@ -346,29 +398,28 @@ def _FormatHeader(root, lang, output_dir):
     elif output.attrs['language_section'] == 'lang':
       language_directive = 'LANGUAGE %s' % GetLangDirectivePair(lang)
   resource_header = resource_header.replace('\\', '\\\\')
-  return '''// This file is automatically generated by GRIT.  Do not edit.
+  return _HEADER_TEMPLATE % {'resource_header': resource_header,
+                             'language_directive': language_directive}
+# end _FormatHeader() function
 
-#include "%s"
-#include <winresrc.h>
-#ifdef IDC_STATIC
-#undef IDC_STATIC
-#endif
-#define IDC_STATIC (-1)
 
-%s
+# Matches the characters that need escaping in string table messages:
+# quotation marks and all different types of linebreaks.
+_MESSAGE_ESCAPE = lazy_re.compile('"|\r\n|\n|\r')
 
 
-''' % (resource_header, language_directive)
-# end _FormatHeader() function
+def _EscapeMessageChar(match):
+  # Escape quotation marks (RC format uses doubling-up) and replace
+  # linebreaks with a \n escape.
+  if match.group(0) == '"':
+    return '""'
+  return r'\n'
 
 
 def FormatMessage(item, lang):
   '''Returns a single message of a string table.'''
   message = item.ws_at_start + item.Translate(lang) + item.ws_at_end
-  # Escape quotation marks (RC format uses doubling-up
-  message = message.replace('"', '""')
-  # Replace linebreaks with a \n escape
-  message = util.LINEBREAKS.sub(r'\\n', message)
+  message = _MESSAGE_ESCAPE.sub(_EscapeMessageChar, message)
   if hasattr(item.GetRoot(), 'GetSubstituter'):
     substituter = item.GetRoot().GetSubstituter()
     message = substituter.Substitute(message)
@@ -378,6 +429,19 @@ def FormatMessage(item, lang):
   return '  %-15s "%s"\n' % (name_attr, message)
 
 
+def _FormatStringTable(item, lang):
+  '''Formats all active messages in a <messages> node as one STRINGTABLE.'''
+  from grit.node import message
+
+  parts = ['STRINGTABLE\nBEGIN\n']
+  for subitem in item.ActiveDescendants():
+    if isinstance(subitem, message.MessageNode):
+      with subitem:
+        parts.append(FormatMessage(subitem, lang))
+  parts.append('END\n\n')
+  return ''.join(parts)
+
+
 def _FormatSection(item, lang, output_dir):
   '''Writes out an .rc file section.'''
   assert isinstance(lang, types.StringTypes)
@@ -400,6 +464,14 @@ def _FormatSection(item, lang, output_dir):
     return text
 
 
+# Maps (IncludeNode, absolute output_dir) to the formatted .rc line for that
+# node.  The line for an <include> does not depend on the output language, so
+# it only needs to be computed once for every .rc file written to the same
+# directory.  Relative output directories are made absolute because the line
+# holds paths computed from the current working directory.
+_cached_include_lines = {}
+
+
 def FormatInclude(item, lang, output_dir, type=None, process_html=False):
   '''Formats an item that is included in an .rc file (e.g. an ICON).
 
@@ -410,16 +482,23 @@ def FormatInclude(item, lang, output_dir, type=None, process_html=False):
           StructureNode)
     process_html: False/True (ignored unless item is a StructureNode)
   '''
+  # Only IncludeNodes that already passed the checks below are cached, so
+  # a hit can skip them.
+  cache_key = (item, os.path.abspath(output_dir))
+  line = _cached_include_lines.get(cache_key)
+  if line is not None:
+    return line
+
   assert isinstance(lang, types.StringTypes)
   from grit.node import structure
   from grit.node import include
   assert isinstance(item, (structure.StructureNode, include.IncludeNode))
 
   if isinstance(item, include.IncludeNode):
-    type = item.attrs['type'].upper()
-    process_html = item.attrs['flattenhtml'] == 'true'
-    filename_only = item.attrs['filenameonly'] == 'true'
-    relative_path = item.attrs['relativepath'] == 'true'
+    type = item.rc_type
+    process_html = item.flatten_html
+    filename_only = item.filename_only
+    relative_path = item.relative_path
   else:
     assert (isinstance(item, structure.StructureNode) and item.attrs['type'] in
         ['admin_template', 'chrome_html', 'chrome_scaled_image', 'igoogle',
@@ -444,8 +523,11 @@ def FormatInclude(item, lang, output_dir, type=None, process_html=False):
 
   if isinstance(item, structure.StructureNode) and item.IsExcludedFromRc():
     return ''
-  else:
-    return '%-18s %-18s "%s"\n' % (item.attrs['name'], type, filename)
+
+  line = '%-18s %-18s "%s"\n' % (item.attrs['name'], type, filename)
+  if isinstance(item, include.IncludeNode):
+    _cached_include_lines[cache_key] = line
+  return line
 
 
 def _DoNotFormat(item, lang, output_dir):
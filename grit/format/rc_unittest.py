@@ -7,16 +7,23 @@
 
 import os
 import re
+import shutil
 import sys
 if __name__ == '__main__':
   sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
 
 import tempfile
 import unittest
-import StringIO
+import warnings
+try:
+  import cStringIO as StringIO
+except ImportError:
+  import StringIO
 
 from grit import grd_reader
 from grit import util
+from grit.format import rc
+from grit.node import include
 from grit.node import structure
 from grit.tool import build
 
@@ -30,6 +37,15 @@ _PREAMBLE = '''\
 #define IDC_STATIC (-1)
 '''
 
+# An <include> of a single flattened HTML file, formatted with its filename.
+_FLATTENED_INCLUDE_GRD = '''
+      <includes>
+        <include name="HTML_FILE1" flattenhtml="true" file="%s" type="BINDATA" />
+      </includes>'''
+
+# Matches the drive letter at the start of a quoted absolute Windows path.
+_DRIVE_LETTER_RE = re.compile('"[c-zC-Z]:')
+
 
 class DummyOutput(object):
   def __init__(self, type, language, file = 'hello.gif'):
@@ -151,8 +167,7 @@ BEGIN
         VALUE "Translation", 0x409, 1200
     END
 END'''.strip()
-    for expected_line, output_line in zip(expected.split(), output.split()):
-      self.assertEqual(expected_line, output_line)
+    self.assertEqual(expected.split(), output.split())
 
   def testRcIncludeStructure(self):
     root = util.ParseGrdForUnittest('''
@@ -171,7 +186,7 @@ END'''.strip()
                 % (util.normpath('/temp/bingo.html').replace('\\', '\\\\'),
                    util.normpath('/temp/bingo2.html').replace('\\', '\\\\')))
     # hackety hack to work on win32&lin
-    output = re.sub('"[c-zC-Z]:', '"', output)
+    output = _DRIVE_LETTER_RE.sub('"', output)
     self.assertEqual(expected, output)
 
   def testRcIncludeFile(self):
@@ -190,16 +205,13 @@ END'''.strip()
                 % (util.normpath('/temp/bingo.txt').replace('\\', '\\\\'),
                    'bingo2.txt'))
     # hackety hack to work on win32&lin
-    output = re.sub('"[c-zC-Z]:', '"', output)
+    output = _DRIVE_LETTER_RE.sub('"', output)
     self.assertEqual(expected, output)
 
   def testRcIncludeFlattenedHtmlFile(self):
     input_file = util.PathFromRoot('grit/testdata/include_test.html')
     output_file = '%s/HTML_FILE1_include_test.html' % tempfile.gettempdir()
-    root = util.ParseGrdForUnittest('''
-      <includes>
-        <include name="HTML_FILE1" flattenhtml="true" file="%s" type="BINDATA" />
-      </includes>''' % input_file)
+    root = util.ParseGrdForUnittest(_FLATTENED_INCLUDE_GRD % input_file)
 
     buf = StringIO.StringIO()
     build.RcBuilder.ProcessNode(root, DummyOutput('rc_all', 'en', output_file),
@@ -209,7 +221,7 @@ END'''.strip()
     expected = (_PREAMBLE +
         u'HTML_FILE1         BINDATA            "HTML_FILE1_include_test.html"')
     # hackety hack to work on win32&lin
-    output = re.sub('"[c-zC-Z]:', '"', output)
+    output = _DRIVE_LETTER_RE.sub('"', output)
     self.assertEqual(expected, output)
 
     file_contents = util.ReadFile(output_file, util.RAW_TEXT)
@@ -230,6 +242,49 @@ END'''.strip()
     self.failUnless(file_contents.find('</if>') == -1)
 
 
+  def testRcIncludeFlattenedHtmlFileMultipleLanguages(self):
+    input_file = util.PathFromRoot('grit/testdata/include_test.html')
+    output_file = '%s/HTML_FILE1_include_test.html' % tempfile.gettempdir()
+    root = util.ParseGrdForUnittest(_FLATTENED_INCLUDE_GRD % input_file)
+
+    # The .rc entry for an <include> is the same for every language written
+    # to the same output directory.
+    outputs = []
+    for lang in ('en', 'fr'):
+      buf = StringIO.StringIO()
+      build.RcBuilder.ProcessNode(root, DummyOutput('rc_all', lang, output_file),
+                                  buf)
+      outputs.append(util.StripBlankLinesAndComments(buf.getvalue()))
+    expected = (_PREAMBLE +
+        u'HTML_FILE1         BINDATA            "HTML_FILE1_include_test.html"')
+    self.assertEqual([expected, expected], outputs)
+
+
+  def testRcIncludeDependsOnWorkingDirectory(self):
+    temp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, temp_dir)
+    # With a relative base_dir and output_dir, the path in the include line
+    # is resolved against the current working directory.
+    root = util.ParseGrdForUnittest('''
+        <includes>
+          <include name="IDI_ICON" file="icon.ico" type="ICON" />
+        </includes>''', base_dir='.')
+    include_node, = root.GetChildrenOfType(include.IncludeNode)
+
+    old_cwd = os.getcwd()
+    try:
+      expected = []
+      lines = []
+      for name in ('a', 'b'):
+        os.mkdir(os.path.join(temp_dir, name))
+        os.chdir(os.path.join(temp_dir, name))
+        expected.append('IDI_ICON           ICON               "%s"\n' %
+                        os.path.abspath('icon.ico').replace('\\', '\\\\'))
+        lines.append(rc.FormatInclude(include_node, 'en', '.'))
+    finally:
+      os.chdir(old_cwd)
+    self.assertEqual(expected, lines)
+
   def testStructureNodeOutputfile(self):
     input_file = util.PathFromRoot('grit/testdata/simple.html')
     root = util.ParseGrdForUnittest('''\
@@ -275,7 +330,7 @@ END'''.strip()
     expected = (_PREAMBLE +
         u'HTML_FILE1         BINDATA            "HTML_FILE1_chrome_html.html"')
     # hackety hack to work on win32&lin
-    output = re.sub('"[c-zC-Z]:', '"', output)
+    output = _DRIVE_LETTER_RE.sub('"', output)
     self.assertEqual(expected, output)
 
     file_contents = util.ReadFile(output_file, util.RAW_TEXT)
@@ -404,6 +459,40 @@ BEGIN
 END
 '''.strip(), output.strip())
 
+  def testGetUnifiedLangCode(self):
+    self.assertEqual('en', rc.GetUnifiedLangCode('en'))
+    self.assertEqual('zh-TW', rc.GetUnifiedLangCode('zh-TW'))
+    self.assertEqual('zh-TW', rc.GetUnifiedLangCode('zh_tw'))
+    self.assertEqual('es-419', rc.GetUnifiedLangCode('es-419'))
+
+  def testRcSubstitutions(self):
+    text = '[GRITVERLANGCHARSETHEX] [GRITVERLANGID] [GRITVERCHARSETID]'
+    substituter = util.Substituter()
+    rc.RcSubstitutions(substituter, 'pt_br')
+    self.assertEqual('041604e4 0x0416 1252', substituter.Substitute(text))
+    substituter = util.Substituter()
+    rc.RcSubstitutions(substituter, 'no-specific-language')
+    self.assertEqual('  ', substituter.Substitute(text))
+
+  def testUndefinedLanguageWarnsOnce(self):
+    old_warned_missing = rc._warned_missing
+    rc._warned_missing = set()
+    try:
+      with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        self.assertEqual('', rc.GetLangIdHex('xx-undefined'))
+        self.assertEqual('', rc.GetLangIdHex('xx-undefined'))
+        self.assertEqual('', rc.GetCharsetIdDecimal('xx-undefined'))
+    finally:
+      rc._warned_missing = old_warned_missing
+    # The warnings are attributed to this file, not to rc.py.
+    self.assertEqual(['rc_unittest.py'] * 2,
+                     [os.path.basename(w.filename) for w in caught])
+    self.assertEqual(
+        ['GetLangIdHex() found undefined language xx-undefined',
+         'GetCharsetIdDecimal() found undefined language xx-undefined'],
+        [str(w.message) for w in caught])
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -6,15 +6,148 @@
 """Handling of the <include> element.
 """
 
+import hashlib
+import multiprocessing
 import os
-
-import grit.format.html_inline
-import grit.format.rc_header
-import grit.format.rc
+import tempfile
+import time
 
 from grit.node import base
 from grit import util
 
+
+# If set, flattened HTML is cached in this directory across GRIT runs.  Each
+# entry is a .bin file with the flattened data, next to a .deps manifest of the
+# files that were inlined into it.
+_FLATTEN_CACHE_DIR_ENV_VAR = 'GRIT_FLATTEN_CACHE_DIR'
+
+# Files modified less than this many seconds before flattening started are not
+# cached, since they may have changed while being read.  This allows for file
+# systems that store timestamps with a granularity of up to two seconds.
+_FLATTEN_CACHE_RACY_SECONDS = 2
+
+# Flattened data shared between <include> nodes of the same tree that refer to
+# the same file.  Keys are (root, real path, allow_external_script, context)
+# where context is the return value of IncludeNode._GetFlattenContext().
+_flattened_data_cache = {}
+
+
+def _Flatten(filename, grd_node, allow_external_script):
+  """Flattens |filename| like html_inline.InlineToString() does.  Returns the
+  flattened data and the set of files it was built from, including
+  |filename| itself."""
+  from grit.format import html_inline
+  try:
+    inlined = html_inline.DoInline(
+        filename, grd_node, allow_external_script=allow_external_script)
+  except IOError, e:
+    raise Exception("Failed to open %s while trying to flatten %s. (%s)" %
+                    (e.filename, filename, e.strerror))
+  return inlined.inlined_data, inlined.inlined_files | set([filename])
+
+
+def _GetFileStamp(filename):
+  """Returns a string that changes whenever |filename| is modified."""
+  stat = os.stat(filename)
+  return '%r %d' % (stat.st_mtime, stat.st_size)
+
+
+def _GetManifestFilename(cache_filename):
+  return os.path.splitext(cache_filename)[0] + '.deps'
+
+
+def _ReadFlattenCache(cache_filename):
+  """Returns the flattened data stored in |cache_filename|, or None if there is
+  no entry or a file it was built from has changed since.
+
+  The first line of the manifest is a hash of the data, so a manifest and data
+  file written by two different GRIT processes are never used together.  Each
+  further line holds the stamp and name of an inlined file.
+  """
+  try:
+    manifest = util.ReadFile(_GetManifestFilename(cache_filename),
+                             util.BINARY).splitlines()
+    data = util.ReadFile(cache_filename, util.BINARY)
+  except (IOError, OSError):
+    return None
+  if not manifest or manifest[0] != hashlib.sha1(data).hexdigest():
+    return None
+  for line in manifest[1:]:
+    try:
+      mtime, size, filename = line.split(' ', 2)
+      if _GetFileStamp(filename) != mtime + ' ' + size:
+        return None
+    except (ValueError, OSError):
+      # A malformed manifest is treated like any other cache miss.
+      return None
+  return data
+
+
+def _AtomicWriteFile(filename, data):
+  """Atomically writes |data| to |filename|.  Returns False on failure."""
+  cache_dir = os.path.dirname(filename)
+  try:
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+    fd, temp_filename = tempfile.mkstemp(dir=cache_dir)
+  except (IOError, OSError):
+    return False
+  try:
+    with os.fdopen(fd, 'wb') as outfile:
+      outfile.write(data)
+    if os.name == 'nt' and os.path.exists(filename):
+      # On Windows rename does not replace an existing file.
+      os.remove(filename)
+    os.rename(temp_filename, filename)
+  except (IOError, OSError):
+    # E.g. another process recreated the file between the remove and rename.
+    if os.path.exists(temp_filename):
+      os.remove(temp_filename)
+    return False
+  return True
+
+
+def _WriteFlattenCache(cache_filename, data, inlined_files, start_time):
+  """Stores |data|, flattened from |inlined_files| starting at |start_time|,
+  in |cache_filename|.  Failures are ignored, the cache is only an
+  optimization."""
+  manifest = [hashlib.sha1(data).hexdigest()]
+  try:
+    for filename in sorted(inlined_files):
+      if (os.stat(filename).st_mtime >=
+          start_time - _FLATTEN_CACHE_RACY_SECONDS):
+        # The file may have been saved after it was read; the stamp taken now
+        # could describe newer contents than |data|.
+        return
+      manifest.append(_GetFileStamp(filename) + ' ' + filename)
+  except OSError:
+    return
+  if _AtomicWriteFile(cache_filename, data):
+    _AtomicWriteFile(_GetManifestFilename(cache_filename),
+                     '\n'.join(manifest) + '\n')
+
+
+class _FlattenConditionEvaluator(object):
+  """Stands in for an IncludeNode when flattening in a worker process, which
+  does not have the node tree.  html_inline only uses the node to evaluate
+  <if> expressions."""
+  def __init__(self, context):
+    self.lang, self.context, self.target_platform, defines = context
+    self.defines = dict(defines)
+
+  def EvaluateCondition(self, expr):
+    return base.Node.EvaluateExpression(
+        expr, self.defines, self.target_platform,
+        {'lang': self.lang, 'context': self.context})
+
+
+def _FlattenInWorker(args):
+  """Flattens a file in a worker process for FlattenIncludes()."""
+  filename, allow_external_script, context = args
+  return _Flatten(filename, _FlattenConditionEvaluator(context),
+                  allow_external_script)
+
+
 class IncludeNode(base.Node):
   """An <include> element."""
   def __init__(self):
@@ -26,16 +159,90 @@ class IncludeNode(base.Node):
     # Also keep track of the last filename we flattened to, so we can
     # avoid doing it more than once.
     self._last_flat_filename = None
+    # The name of the flattened file, without the output directory.
+    self._flat_basename = None
+    # Cache the real path of the included file, since it is needed by every
+    # formatter that touches this node.
+    self._real_path = None
+    # Cache the files this file inlines, since build systems may ask for
+    # the dependency list more than once.
+    self._resource_filenames = None
+
+    # Valid after EndParsing, these are the boolean attributes and the
+    # upper-cased .rc resource type that formatters check for every output.
+    self.flatten_html = False
+    self.allow_external_script = False
+    self.filename_only = False
+    self.relative_path = False
+    self.rc_type = ''
 
   def _IsValidChild(self, child):
     return False
 
+  def EndParsing(self):
+    super(IncludeNode, self).EndParsing()
+    self.flatten_html = self.attrs['flattenhtml'] == 'true'
+    self.allow_external_script = self.attrs['allowexternalscript'] == 'true'
+    self.filename_only = self.attrs['filenameonly'] == 'true'
+    self.relative_path = self.attrs['relativepath'] == 'true'
+    self.rc_type = self.attrs['type'].upper()
+
+  def _GetRealPath(self):
+    if self._real_path is None:
+      self._real_path = self.ToRealPath(self.GetInputPath())
+    return self._real_path
+
+  def _GetFlattenContext(self):
+    """Returns a hashable tuple of the variables that <if> expressions in the
+    flattened file can depend on."""
+    root = self.GetRoot()
+    return (getattr(root, 'output_language', ''),
+            getattr(root, 'output_context', ''),
+            getattr(root, 'target_platform', ''),
+            tuple(sorted(getattr(root, 'defines', {}).items())))
+
+  def _GetFlattenCacheFilename(self, filename, allow_external_script):
+    """Returns the file in the flatten cache directory holding the flattened
+    contents of |filename|, or None if the cache is disabled.  The name is a
+    hash of the variables that <if> expressions can depend on; whether the
+    entry is still up to date is checked by _ReadFlattenCache().
+    """
+    cache_dir = os.environ.get(_FLATTEN_CACHE_DIR_ENV_VAR)
+    if not cache_dir:
+      return None
+    from grit.format import html_inline
+    key = hashlib.sha1()
+    for part in (filename, allow_external_script,
+                 html_inline.GetDistribution(), self._GetFlattenContext()):
+      key.update(repr(part))
+    return os.path.join(cache_dir, key.hexdigest() + '.bin')
+
+  def _GetFlattenKey(self, allow_external_script):
+    """Returns the key of this node's flattened data in
+    _flattened_data_cache."""
+    return (self.GetRoot(), self._GetRealPath(), allow_external_script,
+            self._GetFlattenContext())
+
+  def _FlattenFile(self, filename, allow_external_script):
+    cache_filename = self._GetFlattenCacheFilename(filename,
+                                                   allow_external_script)
+    if cache_filename:
+      data = _ReadFlattenCache(cache_filename)
+      if data is not None:
+        return data
+    start_time = time.time()
+    data, inlined_files = _Flatten(filename, self, allow_external_script)
+    if cache_filename:
+      _WriteFlattenCache(cache_filename, data, inlined_files, start_time)
+    return data
+
   def _GetFlattenedData(self, allow_external_script=False):
     if not self._flattened_data:
-      filename = self.ToRealPath(self.GetInputPath())
-      self._flattened_data = (
-          grit.format.html_inline.InlineToString(filename, self,
-              allow_external_script=allow_external_script))
+      key = self._GetFlattenKey(allow_external_script)
+      if key not in _flattened_data_cache:
+        _flattened_data_cache[key] = self._FlattenFile(self._GetRealPath(),
+                                                       allow_external_script)
+      self._flattened_data = _flattened_data_cache[key]
     return self._flattened_data
 
   def MandatoryAttributes(self):
@@ -68,7 +275,7 @@ class IncludeNode(base.Node):
     """Returns the file for the specified language.  This allows us to return
     different files for different language variants of the include file.
     """
-    return self.ToRealPath(self.GetInputPath())
+    return self._GetRealPath()
 
   def GetDataPackPair(self, lang, encoding):
     """Returns a (id, string) pair that represents the resource id and raw
@@ -79,11 +286,11 @@ class IncludeNode(base.Node):
     from grit.format import rc_header
     id_map = rc_header.GetIds(self.GetRoot())
     id = id_map[self.GetTextualIds()[0]]
-    if self.attrs['flattenhtml'] == 'true':
-      allow_external_script = self.attrs['allowexternalscript'] == 'true'
-      data = self._GetFlattenedData(allow_external_script=allow_external_script)
+    if self.flatten_html:
+      data = self._GetFlattenedData(
+          allow_external_script=self.allow_external_script)
     else:
-      filename = self.ToRealPath(self.GetInputPath())
+      filename = self._GetRealPath()
       data = util.ReadFile(filename, util.BINARY)
 
     # Include does not care about the encoding, because it only returns binary
@@ -93,25 +300,27 @@ class IncludeNode(base.Node):
   def Process(self, output_dir):
     """Rewrite file references to be base64 encoded data URLs.  The new file
     will be written to output_dir and the name of the new file is returned."""
-    filename = self.ToRealPath(self.GetInputPath())
-    flat_filename = os.path.join(output_dir,
-        self.attrs['name'] + '_' + os.path.basename(filename))
+    if self._flat_basename is None:
+      self._flat_basename = (self.attrs['name'] + '_' +
+                             os.path.basename(self._GetRealPath()))
+    flat_filename = os.path.join(output_dir, self._flat_basename)
 
     if self._last_flat_filename == flat_filename:
-      return
+      return self._flat_basename
 
     with open(flat_filename, 'wb') as outfile:
       outfile.write(self._GetFlattenedData())
 
     self._last_flat_filename = flat_filename
-    return os.path.basename(flat_filename)
+    return self._flat_basename
 
   def GetHtmlResourceFilenames(self):
     """Returns a set of all filenames inlined by this file."""
-    allow_external_script = self.attrs['allowexternalscript'] == 'true'
-    return grit.format.html_inline.GetResourceFilenames(
-         self.ToRealPath(self.GetInputPath()),
-         allow_external_script=allow_external_script)
+    if self._resource_filenames is None:
+      from grit.format import html_inline
+      self._resource_filenames = html_inline.GetResourceFilenames(
+          self._GetRealPath(), allow_external_script=self.allow_external_script)
+    return set(self._resource_filenames)
 
   def IsResourceMapSource(self):
     return True
@@ -130,10 +339,10 @@ class IncludeNode(base.Node):
     by parameters of the same name.
     """
     # Convert types to appropriate strings
-    translateable = util.BoolToString(translateable)
-    filenameonly = util.BoolToString(filenameonly)
-    mkoutput = util.BoolToString(mkoutput)
-    relativepath = util.BoolToString(relativepath)
+    translateable = 'true' if translateable else 'false'
+    filenameonly = 'true' if filenameonly else 'false'
+    mkoutput = 'true' if mkoutput else 'false'
+    relativepath = 'true' if relativepath else 'false'
 
     node = IncludeNode()
     node.StartParsing('include', parent)
@@ -146,3 +355,45 @@ class IncludeNode(base.Node):
     node.HandleAttribute('relativepath', relativepath)
     node.EndParsing()
     return node
+
+
+def FlattenIncludes(root, jobs):
+  """Flattens the HTML of all active <include flattenhtml="true"> nodes under
+  |root| in |jobs| worker processes, using the current output context.  The
+  results are picked up by the nodes when they are formatted, so this is
+  purely an optimization for trees with many files to flatten.
+  """
+  pending = {}
+  for node in root.ActiveDescendants():
+    if (isinstance(node, IncludeNode) and node.flatten_html and
+        not node._flattened_data):
+      key = node._GetFlattenKey(node.allow_external_script)
+      if key not in _flattened_data_cache:
+        pending[key] = node
+
+  work = []
+  for key, node in pending.iteritems():
+    filename = node._GetRealPath()
+    cache_filename = node._GetFlattenCacheFilename(filename,
+                                                   node.allow_external_script)
+    data = cache_filename and _ReadFlattenCache(cache_filename)
+    if data is not None:
+      _flattened_data_cache[key] = data
+    else:
+      work.append((key, cache_filename, (filename, node.allow_external_script,
+                                         node._GetFlattenContext())))
+  if len(work) < 2 or jobs < 2:
+    # Not worth starting processes for; the nodes will flatten on demand.
+    return
+
+  start_time = time.time()
+  pool = multiprocessing.Pool(min(jobs, len(work)))
+  try:
+    results = pool.map(_FlattenInWorker, [args for _, _, args in work])
+  finally:
+    pool.close()
+    pool.join()
+  for (key, cache_filename, _), (data, inlined_files) in zip(work, results):
+    _flattened_data_cache[key] = data
+    if cache_filename:
+      _WriteFlattenCache(cache_filename, data, inlined_files, start_time)
@@ -10,8 +10,12 @@ import sys
 if __name__ == '__main__':
   sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
 
+import hashlib
 import os
+import shutil
 import StringIO
+import tempfile
+import time
 import unittest
 
 from grit.node import misc
@@ -69,6 +73,185 @@ class IncludeNodeUnittest(unittest.TestCase):
                      util.normpath(
                        os.path.join(ur'../', ur'flugel/kugel.pdf')))
 
+  def testFlattenSharedFile(self):
+    root = util.ParseGrdForUnittest('''
+      <includes>
+        <include name="IDR_ONE" file="include_test.html" type="BINDATA"
+                 flattenhtml="true" />
+        <include name="IDR_TWO" file="include_test.html" type="BINDATA"
+                 flattenhtml="true" />
+      </includes>''', base_dir=util.PathFromRoot('grit/testdata'))
+    one, two = root.GetChildrenOfType(include.IncludeNode)
+    data_one = one.GetDataPackPair('en', util.BINARY)[1]
+    data_two = two.GetDataPackPair('en', util.BINARY)[1]
+    self.assertTrue('Hello Include!' in data_one)
+    # The file is only flattened once for both nodes.
+    self.assertTrue(data_one is data_two)
+
+  def testProcessTwice(self):
+    root = util.ParseGrdForUnittest('''
+      <includes>
+        <include name="IDR_ONE" file="include_test.html" type="BINDATA"
+                 flattenhtml="true" />
+      </includes>''', base_dir=util.PathFromRoot('grit/testdata'))
+    include_node, = root.GetChildrenOfType(include.IncludeNode)
+    output_dir = tempfile.mkdtemp()
+    try:
+      self.assertEqual('IDR_ONE_include_test.html',
+                       include_node.Process(output_dir))
+      # The file is not written again, but its name is still returned.
+      self.assertEqual('IDR_ONE_include_test.html',
+                       include_node.Process(output_dir))
+    finally:
+      shutil.rmtree(output_dir)
+
+  def testFlattenIncludesInParallel(self):
+    temp_dir = tempfile.mkdtemp()
+    try:
+      for name in ('one.html', 'two.html'):
+        with open(os.path.join(temp_dir, name), 'wb') as f:
+          f.write('%s<if expr="pp_ifdef(\'foo\')">foo</if>'
+                  '<if expr="lang == \'fr\'">fr</if>' % name)
+      root = util.ParseGrdForUnittest('''
+        <includes>
+          <include name="IDR_ONE" file="one.html" type="BINDATA"
+                   flattenhtml="true" />
+          <include name="IDR_TWO" file="two.html" type="BINDATA"
+                   flattenhtml="true" />
+        </includes>''', base_dir=temp_dir)
+      root.SetOutputLanguage('fr')
+      root.SetDefines({'foo': '1'})
+      include.FlattenIncludes(root, 2)
+
+      # The data must come from the worker processes.
+      os.remove(os.path.join(temp_dir, 'one.html'))
+      os.remove(os.path.join(temp_dir, 'two.html'))
+      one, two = root.GetChildrenOfType(include.IncludeNode)
+      self.assertEqual('one.htmlfoofr',
+                       one.GetDataPackPair('fr', util.BINARY)[1])
+      self.assertEqual('two.htmlfoofr',
+                       two.GetDataPackPair('fr', util.BINARY)[1])
+    finally:
+      shutil.rmtree(temp_dir)
+
+  def _SetFlattenCacheDir(self, cache_dir):
+    old_cache_dir = os.environ.get(include._FLATTEN_CACHE_DIR_ENV_VAR)
+    os.environ[include._FLATTEN_CACHE_DIR_ENV_VAR] = cache_dir
+    def Restore():
+      if old_cache_dir is None:
+        del os.environ[include._FLATTEN_CACHE_DIR_ENV_VAR]
+      else:
+        os.environ[include._FLATTEN_CACHE_DIR_ENV_VAR] = old_cache_dir
+    self.addCleanup(Restore)
+
+  def _CountFlattens(self):
+    flattened = []
+    old_flatten = include._Flatten
+    def Flatten(filename, grd_node, allow_external_script):
+      flattened.append(filename)
+      return old_flatten(filename, grd_node, allow_external_script)
+    include._Flatten = Flatten
+    def Restore():
+      include._Flatten = old_flatten
+    self.addCleanup(Restore)
+    return flattened
+
+  def _WriteOldFile(self, filename, contents, age=60):
+    """Writes a file that is old enough for its flattened data to be cached."""
+    with open(filename, 'wb') as f:
+      f.write(contents)
+    mtime = time.time() - age
+    os.utime(filename, (mtime, mtime))
+
+  def _FlattenPage(self, temp_dir):
+    root = util.ParseGrdForUnittest('''
+      <includes>
+        <include name="IDR_PAGE" file="page.html" type="BINDATA"
+                 flattenhtml="true" />
+      </includes>''', base_dir=temp_dir)
+    root.SetTargetPlatform('linux2')
+    include_node, = root.GetChildrenOfType(include.IncludeNode)
+    return include_node.GetDataPackPair('en', util.BINARY)[1]
+
+  def testFlattenCache(self):
+    temp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, temp_dir)
+    cache_dir = os.path.join(temp_dir, 'cache')
+    self._SetFlattenCacheDir(cache_dir)
+    flattened = self._CountFlattens()
+    html_file = os.path.join(temp_dir, 'page.html')
+    def Flatten(contents=None, age=60):
+      if contents is not None:
+        self._WriteOldFile(html_file, contents, age)
+      return self._FlattenPage(temp_dir)
+
+    self.assertEqual('<p>first</p>', Flatten('<p>first</p>', age=120))
+    self.assertEqual(1, len(flattened))
+    self.assertEqual(2, len(os.listdir(cache_dir)))
+    # An unchanged input is read back from the cache.
+    self.assertEqual('<p>first</p>', Flatten())
+    self.assertEqual(1, len(flattened))
+    # A change to the input file must not be hidden by the cache.
+    self.assertEqual('<p>second!</p>', Flatten('<p>second!</p>'))
+    self.assertEqual(2, len(flattened))
+    self.assertEqual('<p>second!</p>', Flatten())
+    self.assertEqual(2, len(flattened))
+    # A file saved just before flattening may have changed while it was read,
+    # so it is not cached.
+    self.assertEqual('<p>third</p>', Flatten('<p>third</p>', age=0))
+    self.assertEqual('<p>third</p>', Flatten())
+    self.assertEqual(4, len(flattened))
+
+  def testFlattenCacheMalformedManifest(self):
+    temp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, temp_dir)
+    cache_filename = os.path.join(temp_dir, 'entry.bin')
+    with open(cache_filename, 'wb') as f:
+      f.write('data')
+    with open(os.path.join(temp_dir, 'entry.deps'), 'wb') as f:
+      f.write(hashlib.sha1('data').hexdigest() + '\nnot-a-stamp\n')
+    self.assertEqual(None, include._ReadFlattenCache(cache_filename))
+
+  def testAtomicWriteFileReplacesExistingFile(self):
+    temp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, temp_dir)
+    filename = os.path.join(temp_dir, 'entry.bin')
+    self.failUnless(include._AtomicWriteFile(filename, 'old'))
+    self.failUnless(include._AtomicWriteFile(filename, 'new'))
+    self.assertEqual('new', util.ReadFile(filename, util.BINARY))
+    # Windows needs the old file removed first, make sure that path works.
+    old_os_name = os.name
+    os.name = 'nt'
+    try:
+      self.failUnless(include._AtomicWriteFile(filename, 'newer'))
+    finally:
+      os.name = old_os_name
+    self.assertEqual('newer', util.ReadFile(filename, util.BINARY))
+    self.assertEqual(['entry.bin'], os.listdir(temp_dir))
+
+  def testFlattenCacheSkipsInactiveBranches(self):
+    # Files in <if> branches that are not taken need not exist, and the cache
+    # only depends on the files that were actually inlined.
+    temp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, temp_dir)
+    self._SetFlattenCacheDir(os.path.join(temp_dir, 'cache'))
+    flattened = self._CountFlattens()
+    self._WriteOldFile(os.path.join(temp_dir, 'page.html'),
+                       '<if expr="is_win">'
+                       '<link rel="stylesheet" href="win_only.css">'
+                       '</if>'
+                       '<link rel="stylesheet" href="style.css">')
+    css_file = os.path.join(temp_dir, 'style.css')
+    self._WriteOldFile(css_file, 'p {}', age=120)
+
+    self.assertEqual('<style>p {}</style>', self._FlattenPage(temp_dir))
+    self.assertEqual('<style>p {}</style>', self._FlattenPage(temp_dir))
+    self.assertEqual(1, len(flattened))
+    # A change to an inlined file invalidates the cached entry.
+    self._WriteOldFile(css_file, 'p { }')
+    self.assertEqual('<style>p { }</style>', self._FlattenPage(temp_dir))
+    self.assertEqual(2, len(flattened))
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -88,6 +88,12 @@ class IfNode(SplicingNode):
   """A node for conditional inclusion of resources.
   """
 
+  def __init__(self):
+    super(IfNode, self).__init__()
+    # (root's condition_generation, value of the expression) from the last
+    # time the condition was evaluated.
+    self._cached_condition = (None, None)
+
   def MandatoryAttributes(self):
     return ['expr']
 
@@ -105,8 +111,17 @@ class IfNode(SplicingNode):
             '<if> element must be <if><then>...</then><else>...</else></if>')
       self.if_then_else = True
 
+  def _IsConditionSatisfied(self):
+    generation = getattr(self.GetRoot(), 'condition_generation', None)
+    if generation is None:
+      return self.EvaluateCondition(self.attrs['expr'])
+    if self._cached_condition[0] != generation:
+      self._cached_condition = (generation,
+                                self.EvaluateCondition(self.attrs['expr']))
+    return self._cached_condition[1]
+
   def ActiveChildren(self):
-    cond = self.EvaluateCondition(self.attrs['expr'])
+    cond = self._IsConditionSatisfied()
     if self.if_then_else:
       return self.children[0 if cond else 1].ActiveChildren()
     else:
@@ -172,6 +187,10 @@ class GritNode(base.Node):
     self.defines = {}
     self.substituter = None
     self.target_platform = sys.platform
+    # Incremented whenever a variable available to <if> expressions changes,
+    # so that nodes can cache the results of their conditions.  Replace
+    # |defines| with SetDefines() rather than modifying it in place.
+    self.condition_generation = 0
 
   def _IsValidChild(self, child):
     from grit.node import empty
@@ -392,17 +411,21 @@ class GritNode(base.Node):
     if output_language != self.output_language:
       self.output_language = output_language
       self.substituter = None  # force recalculate
+      self.condition_generation += 1
 
   def SetOutputContext(self, output_context):
     self.output_context = output_context
     self.substituter = None  # force recalculate
+    self.condition_generation += 1
 
   def SetDefines(self, defines):
     self.defines = defines
     self.substituter = None  # force recalculate
+    self.condition_generation += 1
 
   def SetTargetPlatform(self, target_platform):
     self.target_platform = target_platform
+    self.condition_generation += 1
 
   def GetSubstituter(self):
     if self.substituter is None:
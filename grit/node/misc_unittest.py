@@ -122,6 +122,36 @@ class IfNodeUnittest(unittest.TestCase):
     active = set(grd.ActiveDescendants())
     self.failUnless(is_win_message in active)
 
+  def testIfConditionIsCached(self):
+    grd = grd_reader.Parse(StringIO.StringIO('''
+      <grit latest_public_release="2" source_lang_id="en-US" current_release="3" base_dir=".">
+        <release seq="3">
+          <messages>
+            <if expr="lang == 'fr'">
+              <message name="IDS_HELLO">Bonjour</message>
+            </if>
+          </messages>
+        </release>
+      </grit>'''), dir='.')
+    if_node = grd.children[0].children[0].children[0]
+    hello_message = if_node.children[0]
+
+    evaluations = []
+    def EvaluateCondition(expr):
+      evaluations.append(expr)
+      return misc.IfNode.EvaluateCondition(if_node, expr)
+    if_node.EvaluateCondition = EvaluateCondition
+
+    grd.SetOutputLanguage('fr')
+    self.failUnless(hello_message in set(grd.ActiveDescendants()))
+    self.failUnless(hello_message in set(grd.ActiveDescendants()))
+    self.assertEqual(1, len(evaluations))
+
+    # Changing the language must re-evaluate the condition.
+    grd.SetOutputLanguage('en')
+    self.failUnless(hello_message not in set(grd.ActiveDescendants()))
+    self.assertEqual(2, len(evaluations))
+
   def testElsiness(self):
     grd = util.ParseGrdForUnittest('''
         <messages>
@@ -162,7 +162,7 @@ class StructureNode(base.Node):
         self.attrs['name'] + '_' + os.path.basename(filename))
 
     if self._last_flat_filename == flat_filename:
-      return
+      return os.path.basename(flat_filename)
 
     with open(flat_filename, 'wb') as outfile:
       if self.ExpandVariables():
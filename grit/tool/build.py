@@ -41,6 +41,11 @@ _format_modules.update(
         [ 'adm', 'admx', 'adml', 'reg', 'doc', 'json',
           'plist', 'plist_strings', 'ios_plist', 'android_policy' ])
 
+# Output types whose formatters read the flattened data of <include
+# flattenhtml="true"> nodes, and so benefit from flattening them up front.
+_FLATTENING_OUTPUT_TYPES = ('data_package', 'rc_all', 'rc_translateable',
+                            'rc_nontranslateable')
+
 
 def GetFormatter(type):
   modulename = 'grit.format.' + _format_modules[type]
@@ -99,6 +104,14 @@ Options:
                     flag should match what sys.platform would report for your
                     target platform; see grit.node.base.EvaluateCondition.
 
+  -j JOBS           Number of processes to use for flattening HTML in <include>
+                    elements with flattenhtml="true". Defaults to 1, which
+                    flattens each file when it is first needed.
+                    If the GRIT_FLATTEN_CACHE_DIR environment variable is set,
+                    flattened files are also cached in that directory and
+                    reused by later builds until one of the files inlined
+                    into them changes.
+
   -h HEADERFORMAT   Custom format string to use for generating rc header files.
                     The string should have two placeholders: {textual_id}
                     and {numeric_id}. E.g. "#define {textual_id} {numeric_id}"
@@ -144,7 +157,7 @@ are exported to translation interchange files (e.g. XMB files), etc.
     output_all_resource_defines = None
     write_only_new = False
     depend_on_stamp = False
-    (own_opts, args) = getopt.getopt(args, 'a:o:D:E:f:w:t:h:',
+    (own_opts, args) = getopt.getopt(args, 'a:o:D:E:f:w:t:h:j:',
         ('depdir=','depfile=','assert-file-list=',
          'output-all-resource-defines',
          'no-output-all-resource-defines',
@@ -179,6 +192,8 @@ are exported to translation interchange files (e.g. XMB files), etc.
         target_platform = val
       elif key == '-h':
         rc_header_format = val
+      elif key == '-j':
+        self.jobs = int(val)
       elif key == '--depdir':
         depdir = val
       elif key == '--depfile':
@@ -262,6 +277,9 @@ are exported to translation interchange files (e.g. XMB files), etc.
     # Whether to compare outputs to their old contents before writing.
     self.write_only_new = False
 
+    # Number of processes used to flatten HTML includes.
+    self.jobs = 1
+
   @staticmethod
   def AddWhitelistTags(start_node, whitelist_names):
     # Walk the tree of nodes added attributes for the nodes that shouldn't
@@ -294,10 +312,14 @@ are exported to translation interchange files (e.g. XMB files), etc.
 
     formatter = GetFormatter(output_node.GetType())
     formatted = formatter(node, output_node.GetLanguage(), output_dir=base_dir)
-    outfile.writelines(formatted)
+    # Formatters yield many small chunks; join them so that the (usually
+    # encoding) output stream is written once rather than once per chunk.
+    outfile.write(''.join(formatted))
 
 
   def Process(self):
+    from grit.node import include
+
     # Update filenames with those provided by SCons if we're being invoked
     # from SCons.  The list of SCons targets also includes all <structure>
     # node outputs, but it starts with our output files, in the order they
@@ -342,6 +364,11 @@ are exported to translation interchange files (e.g. XMB files), etc.
       self.res.SetOutputContext(output.GetContext())
       self.res.SetDefines(self.defines)
 
+      # Flatten HTML includes for this context in parallel, rather than one at
+      # a time as the formatters reach them.
+      if self.jobs > 1 and output.GetType() in _FLATTENING_OUTPUT_TYPES:
+        include.FlattenIncludes(self.res, self.jobs)
+
       # Make the output directory if it doesn't exist.
       self.MakeDirectoriesTo(output.GetOutputFilename())
 
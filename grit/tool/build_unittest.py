@@ -7,6 +7,7 @@
 '''
 
 import codecs
+import multiprocessing
 import os
 import sys
 import tempfile
@@ -301,6 +302,54 @@ class BuildUnittest(unittest.TestCase):
     self.assertTrue(abs(second_mtime - UNCHANGED) > 5)
     self.assertTrue(abs(third_mtime - UNCHANGED) < 5)
 
+  def testParallelFlatten(self):
+    files = {
+      'parallel.grd': '''<?xml version="1.0" encoding="UTF-8"?>
+        <grit latest_public_release="0" current_release="1">
+          <outputs>
+            <output filename="resource.h" type="rc_header" />
+            <output filename="fr.pak" type="data_package" lang="fr" />
+          </outputs>
+          <release seq="1">
+            <includes>
+              <include name="IDR_A" file="a.html" type="BINDATA"
+                       flattenhtml="true" />
+              <include name="IDR_B" file="b.html" type="BINDATA"
+                       flattenhtml="true" />
+              <include name="IDR_C" file="c.html" type="BINDATA"
+                       flattenhtml="true" />
+            </includes>
+          </release>
+        </grit>''',
+      'a.html': '<p>a</p>',
+      'b.html': '<p>b</p>',
+      'c.html': '<p>c</p>',
+    }
+    tmp_dir = util.TempDir(files)
+    self.addCleanup(tmp_dir.CleanUp)
+    output_dir = tempfile.mkdtemp()
+    builder = build.RcBuilder()
+    class DummyOpts(object):
+      def __init__(self):
+        self.input = tmp_dir.GetPath('parallel.grd')
+        self.verbose = False
+        self.extra_verbose = False
+    pool_sizes = []
+    real_pool = multiprocessing.Pool
+    def Pool(processes):
+      pool_sizes.append(processes)
+      return real_pool(processes)
+    multiprocessing.Pool = Pool
+    try:
+      builder.Run(DummyOpts(), ['-o', output_dir, '-j', '3'])
+    finally:
+      multiprocessing.Pool = real_pool
+    self.assertEqual(3, builder.jobs)
+    self.failUnless(os.path.exists(os.path.join(output_dir, 'fr.pak')))
+    # Only the data package reads flattened data, so the header output must
+    # not start a pool of its own.
+    self.assertEqual([3], pool_sizes)
+
   def testGenerateDepFileWithDependOnStamp(self):
     output_dir = tempfile.mkdtemp()
     builder = build.RcBuilder()